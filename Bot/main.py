@@ -1,16 +1,24 @@
 import asyncio
+import hashlib
 import logging
 import os
+import re
 import signal
+import tempfile
+import time
 from contextlib import suppress
-from urllib.parse import urlparse
-from typing import Dict, Any, Optional
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Any, Awaitable, Callable, List, Optional, Tuple
 
-from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command, CommandStart
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
+import orjson
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.filters import Command, CommandObject, CommandStart, Filter
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand, Update
 
-from supabase import create_client, Client
+if TYPE_CHECKING:
+    from supabase import AsyncClient
 
 # =============================
 # Конфиг
@@ -25,16 +33,18 @@ if not BOT_TOKEN:
 if not REG_URL:
     raise RuntimeError("REG_URL не установлен (ссылка на форму регистрации).")
 
+_URL_RE = re.compile(r"^https?://[^/?#\s]+", re.IGNORECASE)
+
 def _is_valid_url(u: str) -> bool:
-    try:
-        p = urlparse(u)
-        return p.scheme in ("http", "https") and bool(p.netloc)
-    except Exception:
-        return False
+    return bool(_URL_RE.match(u))
 
 if not _is_valid_url(REG_URL):
     raise RuntimeError(f"REG_URL выглядит некорректно: {REG_URL!r}")
 
+# если в REG_URL уже есть query, tg_id добавляем через "&"
+_REG_SEP = "&" if "?" in REG_URL else "?"
+_REG_URL_PREFIX = f"{REG_URL}{_REG_SEP}tg_id="
+
 # =============================
 # Логирование
 # =============================
@@ -43,39 +53,112 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
 )
 log = logging.getLogger("fenix-bot")
+# httpx пишет INFO на каждый запрос к PostgREST, aiogram.event — "is handled" на каждый апдейт
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("aiogram.event").setLevel(logging.WARNING)
 
 # =============================
 # Supabase
 # =============================
-supabase: Optional[Client] = None
-if SUPABASE_URL and SUPABASE_KEY:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+supabase: Optional["AsyncClient"] = None
+
+async def init_supabase():
+    global supabase
+    if not (SUPABASE_URL and SUPABASE_KEY):
+        log.warning("SUPABASE_URL/SUPABASE_KEY не заданы — запись в БД не будет работать.")
+        return
+
+    # supabase тянет postgrest/gotrue/storage/realtime — импортируем только когда БД настроена
+    from supabase import acreate_client
+
+    # сессия PostgREST по умолчанию — уже один долгоживущий httpx.AsyncClient
+    # с пулом keep-alive соединений, поэтому её не подменяем
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
     log.info("Supabase client инициализирован")
-else:
-    log.warning("SUPABASE_URL/SUPABASE_KEY не заданы — запись в БД не будет работать.")
 
 # =============================
 # Aiogram
 # =============================
-dp = Dispatcher()
+class TokenBucketMiddleware(BaseMiddleware):
+    """Ограничение частоты сообщений от одного пользователя (token bucket)"""
+
+    def __init__(self, capacity: float = 5, rate: float = 1.0, prune_every: int = 1000):
+        self.capacity = capacity
+        self.rate = rate
+        self.prune_every = prune_every
+        self._buckets: Dict[int, Tuple[float, float]] = {}
+        self._calls = 0
+
+    def _prune(self, now: float):
+        # ведро, простоявшее дольше времени полного заполнения, можно забыть
+        idle = self.capacity / self.rate
+        self._buckets = {uid: b for uid, b in self._buckets.items() if now - b[1] < idle}
+
+    def allow(self, uid: int) -> bool:
+        """Списывает токен пользователя; False — сообщение нужно отбросить"""
+        now = time.monotonic()
+        self._calls += 1
+        if self._calls % self.prune_every == 0:
+            self._prune(now)
+
+        tokens, last = self._buckets.get(uid, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self._buckets[uid] = (tokens, now)
+            return False
+        self._buckets[uid] = (tokens - 1, now)
+        return True
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        if event.from_user is not None and not self.allow(event.from_user.id):
+            return None
+        return await handler(event, data)
 
+dp = Dispatcher()
+rate_limiter = TokenBucketMiddleware()
+dp.message.middleware(rate_limiter)
+
+@dp.update.outer_middleware()
+async def ping_fast_path(
+    handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+    event: Update,
+    data: Dict[str, Any],
+) -> Any:
+    # голый /ping от мониторинга отвечаем сразу, минуя роутеры и фильтры;
+    # /ping@bot и /ping с аргументами обрабатывает обычный cmd_ping
+    # message-middleware сюда не доходит, поэтому токен списываем здесь же
+    m = event.message
+    if m is not None and m.text == "/ping":
+        if m.from_user is not None and not rate_limiter.allow(m.from_user.id):
+            return None
+        return await data["bot"].send_message(m.chat.id, "pong 🧡")
+    return await handler(event, data)
+
+@lru_cache(maxsize=4096)
 def registration_keyboard(tg_id: int) -> InlineKeyboardMarkup:
     # передаём tg_id в ссылку для связи анкеты с пользователем
-    url = f"{REG_URL}?tg_id={tg_id}"
+    url = _REG_URL_PREFIX + str(tg_id)
     return InlineKeyboardMarkup(
         inline_keyboard=[[InlineKeyboardButton(text="🔥 Начать регистрацию", url=url)]]
     )
 
 @dp.message(CommandStart())
 async def cmd_start(m: Message):
+    uid = m.from_user.id
     await m.answer(
         "Привет! Я бот клана ФЕНИКС.\nНажми кнопку, чтобы пройти регистрацию:",
-        reply_markup=registration_keyboard(m.from_user.id)
+        reply_markup=registration_keyboard(uid)
     )
 
 @dp.message(Command("registration"))
 async def cmd_registration(m: Message):
-    await m.answer("Открываю форму регистрации:", reply_markup=registration_keyboard(m.from_user.id))
+    uid = m.from_user.id
+    await m.answer("Открываю форму регистрации:", reply_markup=registration_keyboard(uid))
 
 @dp.message(Command("help"))
 async def cmd_help(m: Message):
@@ -90,74 +173,229 @@ async def cmd_help(m: Message):
 async def cmd_ping(m: Message):
     await m.answer("pong 🧡")
 
-@dp.message(F.text.lower().in_({"регистрация", "registration"}))
+_REG_WORDS = frozenset({"регистрация", "registration"})
+
+class RegistrationWord(Filter):
+    async def __call__(self, m: Message) -> bool:
+        return (m.text or "").casefold() in _REG_WORDS
+
+@dp.message(RegistrationWord())
 async def msg_registration_word(m: Message):
-    await m.answer("Регистрация здесь:", reply_markup=registration_keyboard(m.from_user.id))
+    uid = m.from_user.id
+    await m.answer("Регистрация здесь:", reply_markup=registration_keyboard(uid))
 
 # =============================
 # Upsert в rg_players
 # =============================
 TABLE = "rg_players"
 
-async def upsert_player(record: Dict[str, Any]) -> Dict[str, Any]:
+@dataclass(frozen=True, slots=True)
+class PlayerRecord:
+    """Строка rg_players в том виде, в каком её пишет бот"""
+    telegram_id: Optional[int] = None
+    telegram: Optional[str] = None
+    nickname: Optional[str] = None
+    clan: Optional[str] = None
+
+    def __post_init__(self):
+        if self.telegram:
+            object.__setattr__(self, "telegram", str(self.telegram).strip())
+
+    @property
+    def telegram_norm(self) -> Optional[str]:
+        return self.telegram.lstrip("@").lower() if self.telegram else None
+
+    def payload(self) -> Dict[str, Any]:
+        # None-поля не отправляем, чтобы не затирать существующие значения
+        rec = {k: v for k, v in asdict(self).items() if v is not None}
+        if self.telegram:
+            rec["telegram_norm"] = self.telegram_norm
+        return rec
+
+async def _upsert_now(p: PlayerRecord) -> Dict[str, Any]:
     """Upsert игрока по telegram_id или telegram_norm"""
     if supabase is None:
         raise RuntimeError("Supabase client не инициализирован.")
 
-    rec = dict(record)
-
-    # нормализация
-    if rec.get("telegram"):
-        rec["telegram"] = str(rec["telegram"]).strip()
-        rec["telegram_norm"] = rec["telegram"].lstrip("@").lower()
+    rec = p.payload()
 
     # приоритет — telegram_id
     try:
-        if rec.get("telegram_id"):
-            resp = supabase.table(TABLE).upsert(rec, on_conflict="telegram_id").execute()
+        if p.telegram_id:
+            resp = await supabase.table(TABLE).upsert(rec, on_conflict="telegram_id").execute()
             return {"ok": True, "via": "on_conflict:telegram_id", "data": resp.data}
     except Exception as e:
         log.warning("Upsert по telegram_id не удался: %s", e)
 
-    # fallback — telegram_norm
+    # fallback — telegram_norm (уникальный индекс, см. Bot/migrations)
     try:
-        if rec.get("telegram_norm"):
-            resp = supabase.table(TABLE).upsert(rec, on_conflict="telegram_norm").execute()
+        if p.telegram_norm:
+            resp = await supabase.table(TABLE).upsert(rec, on_conflict="telegram_norm").execute()
             return {"ok": True, "via": "on_conflict:telegram_norm", "data": resp.data}
+        ins = await supabase.table(TABLE).insert(rec).execute()
+        return {"ok": True, "via": "insert", "data": ins.data}
     except Exception as e:
-        log.warning("Upsert по telegram_norm не удался: %s", e)
+        log.error("Ошибка upsert: %s", e)
+        return {"ok": False, "error": str(e)}
+
+def _is_transport_error(e: Exception) -> bool:
+    # сеть/таймаут повторять построчно бессмысленно; ошибки PostgREST (дубликаты,
+    # нет уникального индекса под on_conflict и т.п.) может решить построчный путь
+    import httpx  # уже загружен вместе с supabase
+    return isinstance(e, (httpx.HTTPError, OSError, asyncio.TimeoutError))
+
+async def upsert_players(records: List[PlayerRecord]) -> List[Dict[str, Any]]:
+    """Пакетный upsert: записи с telegram_id — одним запросом, остальные — параллельно"""
+    if supabase is None:
+        raise RuntimeError("Supabase client не инициализирован.")
+
+    recs = [p.payload() for p in records]
+    results: List[Optional[Dict[str, Any]]] = [None] * len(recs)
+
+    # повтор telegram_id в одном пакете Postgres отвергает (ON CONFLICT ... a second time):
+    # пишем последнюю запись пользователя, её результат получают и предыдущие
+    last: Dict[int, int] = {}
+    for i, p in enumerate(records):
+        if p.telegram_id:
+            last[p.telegram_id] = i
+    dupes = {i for i, p in enumerate(records) if p.telegram_id and last[p.telegram_id] != i}
+
+    # PostgREST ждёт одинаковый набор полей в пакете — группируем по ключам
+    groups: Dict[Tuple[str, ...], List[int]] = {}
+    for i in last.values():
+        groups.setdefault(tuple(sorted(recs[i])), []).append(i)
+
+    async def _bulk(idxs: List[int]):
+        try:
+            resp = await supabase.table(TABLE).upsert(
+                [recs[i] for i in idxs], on_conflict="telegram_id"
+            ).execute()
+        except Exception as e:
+            log.warning("Пакетный upsert по telegram_id не удался: %s", e)
+            if _is_transport_error(e):
+                for i in idxs:
+                    results[i] = {"ok": False, "error": str(e)}
+            return
+        for i in idxs:
+            tid = records[i].telegram_id
+            rows = [row for row in resp.data if row.get("telegram_id") == tid]
+            results[i] = {"ok": True, "via": "bulk:telegram_id", "data": rows}
+
+    await asyncio.gather(*(_bulk(idxs) for idxs in groups.values()))
+
+    # остальные (и записи пакетов, отклонённых PostgREST) — по одной, но одновременно
+    rest = [i for i, res in enumerate(results) if res is None and i not in dupes]
+    done = await asyncio.gather(*(_upsert_now(records[i]) for i in rest), return_exceptions=True)
+    for i, res in zip(rest, done):
+        results[i] = {"ok": False, "error": str(res)} if isinstance(res, BaseException) else res
+    for i in dupes:
+        results[i] = results[last[records[i].telegram_id]]
+    return results
+
+# =============================
+# Пакетная запись (очередь + периодический сброс)
+# =============================
+UPSERT_MAX_BATCH = 50
+UPSERT_MAX_DELAY = 0.2  # секунды
+
+UPSERT_DRAIN_TIMEOUT = 5.0  # секунды на дозапись очереди при остановке
+
+_STOP = object()  # сигнал upsert_flusher: дописать очередь и завершиться
+_queue: Optional["asyncio.Queue[Any]"] = None
+
+async def upsert_player(p: PlayerRecord) -> Dict[str, Any]:
+    """Upsert игрока; записи с telegram_id копятся и уходят пачкой"""
+    if supabase is None:
+        raise RuntimeError("Supabase client не инициализирован.")
+    if _queue is None or not p.telegram_id:
+        return await _upsert_now(p)
+
+    fut = asyncio.get_running_loop().create_future()
+    await _queue.put((p, fut))
+    return await fut
 
-    # резервный путь — select/update
+async def _flush(batch: List[Tuple[PlayerRecord, asyncio.Future]]):
     try:
-        tgn = rec.get("telegram_norm")
-        if tgn:
-            found = supabase.table(TABLE).select("id").eq("telegram_norm", tgn).limit(1).execute()
-            if found.data:
-                pid = found.data[0]["id"]
-                upd = supabase.table(TABLE).update(rec).eq("id", pid).execute()
-                return {"ok": True, "via": "fallback:update", "data": upd.data}
-        ins = supabase.table(TABLE).insert(rec).execute()
-        return {"ok": True, "via": "fallback:insert", "data": ins.data}
+        results = await upsert_players([p for p, _ in batch])
     except Exception as e:
-        log.error("Ошибка upsert: %s", e)
-        return {"ok": False, "error": str(e)}
+        log.error("Ошибка пакетного upsert: %s", e)
+        results = [{"ok": False, "error": str(e)}] * len(batch)
+    for (_, fut), res in zip(batch, results):
+        if not fut.done():
+            fut.set_result(res)
+
+def stop_flusher():
+    """Просит upsert_flusher дописать накопленное и завершиться"""
+    if _queue is not None:
+        _queue.put_nowait(_STOP)
+
+async def upsert_flusher():
+    """Фоновая задача: собирает до UPSERT_MAX_BATCH записей за UPSERT_MAX_DELAY и пишет их одним запросом"""
+    global _queue
+    _queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    batch: List[Tuple[PlayerRecord, asyncio.Future]] = []
+    try:
+        stopping = False
+        while not stopping:
+            item = await _queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + UPSERT_MAX_DELAY
+            while len(batch) < UPSERT_MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await _flush(batch)
+            batch = []
+
+        # остановка: новые записи идут напрямую, оставшиеся в очереди дописываем
+        queue, _queue = _queue, None
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item is not _STOP:
+                batch.append(item)
+        for i in range(0, len(batch), UPSERT_MAX_BATCH):
+            await _flush(batch[i:i + UPSERT_MAX_BATCH])
+        batch = []
+    finally:
+        # сюда с недописанными записями попадаем только при отмене задачи
+        if _queue is not None:
+            queue, _queue = _queue, None
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not _STOP:
+                    batch.append(item)
+        for _, fut in batch:
+            if not fut.done():
+                fut.cancel()
 
 # тестовая команда
 @dp.message(Command("test_upsert"))
-async def cmd_test_upsert(m: Message):
+async def cmd_test_upsert(m: Message, command: CommandObject):
+    user = m.from_user
     if supabase is None:
         await m.answer("Supabase не сконфигурирован.")
         return
 
-    args = m.text.split(maxsplit=1)
-    tg_user = args[1].strip() if len(args) > 1 else m.from_user.username or f"user_{m.from_user.id}"
+    tg_user = (command.args or "").strip() or user.username or f"user_{user.id}"
 
-    sample = {
-        "telegram_id": m.from_user.id,
-        "telegram": tg_user,
-        "nickname": "DeKo_Sun",
-        "clan": "Феникс",
-    }
+    sample = PlayerRecord(
+        telegram_id=user.id,
+        telegram=tg_user,
+        nickname="DeKo_Sun",
+        clan="Феникс",
+    )
 
     res = await upsert_player(sample)
     if res.get("ok"):
@@ -168,22 +406,48 @@ async def cmd_test_upsert(m: Message):
 # =============================
 # Служебное
 # =============================
+_COMMANDS = [
+    BotCommand(command="start", description="Приветствие и регистрация"),
+    BotCommand(command="registration", description="Ссылка на регистрацию"),
+    BotCommand(command="help", description="Помощь"),
+    BotCommand(command="ping", description="Проверка связи"),
+    BotCommand(command="test_upsert", description="Тест записи в БД"),
+]
+# id бота входит в хэш, чтобы смена токена не пропустила установку команд
+_COMMANDS_HASH = hashlib.blake2b(
+    (BOT_TOKEN.split(":", 1)[0] + repr(_COMMANDS)).encode()
+).hexdigest()
+_COMMANDS_HASH_FILE = os.path.join(tempfile.gettempdir(), ".cmds_hash")
+
 async def set_commands(bot: Bot):
-    cmds = [
-        BotCommand(command="start", description="Приветствие и регистрация"),
-        BotCommand(command="registration", description="Ссылка на регистрацию"),
-        BotCommand(command="help", description="Помощь"),
-        BotCommand(command="ping", description="Проверка связи"),
-        BotCommand(command="test_upsert", description="Тест записи в БД"),
-    ]
-    await bot.set_my_commands(cmds)
+    try:
+        with open(_COMMANDS_HASH_FILE, encoding="utf-8") as f:
+            if f.read().strip() == _COMMANDS_HASH:
+                log.info("Команды бота не изменились — пропускаю set_my_commands")
+                return
+    except OSError:
+        pass
+
+    await bot.set_my_commands(_COMMANDS)
+    try:
+        with open(_COMMANDS_HASH_FILE, "w", encoding="utf-8") as f:
+            f.write(_COMMANDS_HASH)
+    except OSError as e:
+        log.warning("Не удалось сохранить хэш команд: %s", e)
 
 async def _shutdown(bot: Bot):
     await bot.session.close()
+    if supabase is not None:
+        await supabase.postgrest.aclose()
     log.info("Завершение работы бота")
 
 async def main():
-    bot = Bot(BOT_TOKEN)
+    await init_supabase()
+    session = AiohttpSession(
+        json_loads=orjson.loads,
+        json_dumps=lambda o: orjson.dumps(o).decode(),
+    )
+    bot = Bot(BOT_TOKEN, session=session)
     await set_commands(bot)
     stop_event = asyncio.Event()
 
@@ -194,14 +458,30 @@ async def main():
             loop.add_signal_handler(sig, _handler)
 
     log.info("Запускаю long polling…")
-    polling = asyncio.create_task(dp.start_polling(bot))
-    await stop_event.wait()
-    polling.cancel()
-    with suppress(asyncio.CancelledError):
-        await polling
-    await _shutdown(bot)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            flusher = tg.create_task(upsert_flusher()) if supabase is not None else None
+            # сигналы обрабатываем сами (stop_event), поэтому handle_signals=False
+            polling = tg.create_task(
+                dp.start_polling(
+                    bot,
+                    polling_timeout=25,
+                    handle_signals=False,
+                )
+            )
+            await stop_event.wait()
+            # сначала останавливаем приём апдейтов, затем дописываем очередь в БД
+            polling.cancel()
+            await asyncio.wait([polling])
+            if flusher is not None:
+                stop_flusher()
+                await asyncio.wait([flusher], timeout=UPSERT_DRAIN_TIMEOUT)
+                flusher.cancel()
+    finally:
+        await _shutdown(bot)
 
 if __name__ == "__main__":
+    # uvloop (если установлен) aiogram подключает сам при импорте
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
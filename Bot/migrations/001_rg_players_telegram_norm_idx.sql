@@ -0,0 +1,2 @@
+-- Уникальный индекс для upsert по telegram_norm (on_conflict="telegram_norm")
+CREATE UNIQUE INDEX IF NOT EXISTS rg_players_telegram_norm_idx ON rg_players (telegram_norm);